@@ -29,8 +29,9 @@ function! s:_OnServerData( session_id, channel, data ) abort
     return
   endif
 
+  " Use bindeval to pass the raw bytes, rather than decoding them to a str
   py3 _VimspectorSession( vim.eval( 'a:session_id' ) ).OnChannelData(
-        \ vim.eval( 'a:data' ) )
+        \ vim.bindeval( 'a:data' ) )
 endfunction
 
 function! s:_OnServerError( session_id, channel, data ) abort
@@ -15,13 +15,43 @@
 
 import logging
 import json
+import re
+import sys
 import vim
 
 from vimspector import utils
 
+try:
+  # orjson is optional, but is much faster for large messages
+  import orjson
+except ImportError:
+  orjson = None
+
 DEFAULT_SYNC_TIMEOUT = 5000
 DEFAULT_ASYNC_TIMEOUT = 15000
 
+# Once this many bytes of the receive buffer have been consumed, they are
+# discarded from the front of the buffer
+BUFFER_COMPACT_THRESHOLD = 64 * 1024
+
+LF = b'\n'
+CRLF = b'\r\n'
+CRLFCRLF = b'\r\n\r\n'
+
+HEADER_FORMAT = b'Content-Length: %d\r\n\r\n'
+
+# In practice, Content-Length is the only header that adapters send
+HEADER_RE = re.compile( rb'Content-Length:\s*(\d+)\r\n(?:[^\r\n]+\r\n)*\r\n' )
+
+# Vim's python can call vimscript functions directly, avoiding having to
+# format and parse a vimscript expression for every request. Neovim's can't.
+if hasattr( vim, 'Function' ):
+  _timer_start = vim.Function( 'timer_start' )
+  _timer_stop = vim.Function( 'timer_stop' )
+else:
+  _timer_start = None
+  _timer_stop = None
+
 
 class PendingRequest( object ):
   def __init__( self, msg, handler, failure_handler, expiry_id ):
@@ -47,15 +77,25 @@ class DebugAdapterConnection( object ):
       async_timeout = DEFAULT_ASYNC_TIMEOUT
 
     self._Write = send_func
-    self._SetState( 'READ_HEADER' )
-    self._buffer = bytes()
+    self._buffer = bytearray()
+    self._read_offset = 0
+    self._parser = self._ParseMessages()
     self._handlers = handlers
     self._session_id = session_id
     self._next_message_id = 1
     self._outstanding_requests = {}
+    # Key: timer id, Value: request seq
+    self._timer_to_request_id = {}
     self.async_timeout = async_timeout
     self.sync_timeout = sync_timeout
 
+    if _timer_start is not None:
+      self._timeout_callback = vim.Function(
+        'vimspector#internal#channel#Timeout',
+        args = [ session_id ] )
+    else:
+      self._timeout_callback = None
+
   def GetSessionId( self ):
     return self._session_id
 
@@ -71,45 +111,44 @@ class DebugAdapterConnection( object ):
     this_id = self._next_message_id
     self._next_message_id += 1
 
-    msg[ 'seq' ] = this_id
-    msg[ 'type' ] = 'request'
+    msg |= { 'seq': this_id, 'type': 'request' }
 
-    expiry_id = vim.eval(
-      'timer_start( {}, '
-      '             function( "vimspector#internal#channel#Timeout", '
-      '                       [ {} ] ) )'.format(
-        timeout,
-        self._session_id ) )
+    expiry_id = self._StartTimer( timeout )
 
     request = PendingRequest( msg,
                               handler,
                               failure_handler,
                               expiry_id )
     self._outstanding_requests[ this_id ] = request
+    self._timer_to_request_id[ expiry_id ] = this_id
 
     if not self._SendMessage( msg ):
       self._AbortRequest( request, 'Unable to send message' )
 
 
   def DoRequestSync( self, msg, timeout = None ):
-    result = {}
+    result = { 'done': False }
 
     if timeout is None:
       timeout = self.sync_timeout
 
     def handler( msg ):
       result[ 'response' ] = msg
+      result[ 'done' ] = True
 
     def failure_handler( reason, msg ):
       result[ 'response' ] = msg
       result[ 'exception' ] = RuntimeError( reason )
+      result[ 'done' ] = True
 
     self.DoRequest( handler, msg, failure_handler, timeout )
 
+    # Vim processes channel callbacks while sleeping, so poll often to pick up
+    # the response as soon as it arrives
     to_wait = timeout + 1000
-    while not result and to_wait >= 0:
-      vim.command( 'sleep 10m' )
-      to_wait -= 10
+    while not result[ 'done' ] and to_wait >= 0:
+      vim.command( 'sleep 1m' )
+      to_wait -= 1
 
     if result.get( 'exception' ) is not None:
       raise result[ 'exception' ]
@@ -121,13 +160,7 @@ class DebugAdapterConnection( object ):
 
 
   def OnRequestTimeout( self, timer_id ):
-    request_id = None
-    for seq, request in self._outstanding_requests.items():
-      if request.expiry_id == timer_id:
-        request_id = seq
-        break
-
-    # Avoid modifying _outstanding_requests while looping
+    request_id = self._timer_to_request_id.pop( int( timer_id ), None )
     if request_id is not None:
       request = self._outstanding_requests.pop( request_id )
       self._AbortRequest( request, 'Timeout' )
@@ -136,17 +169,16 @@ class DebugAdapterConnection( object ):
     this_id = self._next_message_id
     self._next_message_id += 1
 
-    msg = {}
-    msg[ 'seq' ] = this_id
-    msg[ 'type' ] = 'response'
-    msg[ 'request_seq' ] = request[ 'seq' ]
-    msg[ 'command' ] = request[ 'command' ]
-    msg[ 'body' ] = response
+    msg = {
+      'seq': this_id,
+      'type': 'response',
+      'request_seq': request[ 'seq' ],
+      'command': request[ 'command' ],
+      'body': response,
+      'success': not error,
+    }
     if error:
-      msg[ 'success' ] = False
       msg[ 'message' ] = error
-    else:
-      msg[ 'success' ] = True
 
     self._SendMessage( msg )
 
@@ -154,14 +186,18 @@ class DebugAdapterConnection( object ):
     self._Write = None
     self._handlers = None
 
-    while self._outstanding_requests:
-      _, request = self._outstanding_requests.popitem()
+    requests = list( self._outstanding_requests.values() )
+    self._outstanding_requests.clear()
+
+    # Stop all of the timers in one go, rather than one vim call per request
+    self._KillTimers( requests )
+    for request in requests:
       self._AbortRequest( request, 'Closing down' )
 
   def _AbortRequest( self, request, reason ):
     self._logger.debug( '{}: Aborting request {}'.format( reason,
                                                           request.msg ) )
-    _KillTimer( request )
+    self._KillTimer( request )
     if request.failure_handler:
       request.failure_handler( reason, {} )
     else:
@@ -171,102 +207,142 @@ class DebugAdapterConnection( object ):
 
 
   def OnData( self, data ):
-    data = bytes( data, 'utf-8' )
     # self._logger.debug( 'Received ({0}/{1}): {2},'.format( type( data ),
     #                                                   len( data ),
     #                                                   data ) )
 
-    self._buffer += data
+    if isinstance( data, str ):
+      # Neovim only gives us decoded text; Vim gives us the raw bytes
+      data = data.encode( 'utf-8', 'surrogateescape' )
 
-    while True:
-      if self._state == 'READ_HEADER':
-        self._ReadHeaders()
+    self._buffer.extend( data )
 
-      if self._state == 'READ_BODY':
-        self._ReadBody()
-      else:
-        break
+    # Dispatch each message as soon as it is parsed. If a handler raises, the
+    # remaining messages are still in the buffer for the next call.
+    message = self._NextMessage()
+    while message is not None:
+      self._OnMessageReceived( message )
+      message = self._NextMessage()
 
-      if self._state != 'READ_HEADER':
-        # We ran out of data whilst reading the body. Await more data.
-        break
+    # Rather than re-slicing the buffer for every message, we just advance the
+    # read offset. Periodically discard the data we have already consumed.
+    if ( self._read_offset == len( self._buffer ) or
+         self._read_offset > BUFFER_COMPACT_THRESHOLD ):
+      del self._buffer[ : self._read_offset ]
+      self._read_offset = 0
 
-  def _SetState( self, state ):
-    self._state = state
-    if state == 'READ_HEADER':
-      self._headers = {}
+  def _NextMessage( self ):
+    try:
+      return next( self._parser )
+    except Exception:
+      # A generator is finished once it raises, so start a new one
+      self._parser = self._ParseMessages()
+      raise
 
   def _SendMessage( self, msg ):
     if not self._Write:
       # Connection was destroyed
       return False
 
-    msg = json.dumps( msg )
-    self._logger.debug( 'Sending Message: {0}'.format( msg ) )
+    if self._logger.isEnabledFor( logging.DEBUG ):
+      self._logger.debug( 'Sending Message: %s', msg )
+
+    # Content-Length is the length in bytes, not characters, so build the
+    # frame as bytes
+    payload = _Dumps( msg )
 
-    data = 'Content-Length: {0}\r\n\r\n{1}'.format( len( msg ), msg )
+    # Send the header and payload in a single write
+    data = HEADER_FORMAT % len( payload ) + payload
     # self._logger.debug( 'Sending: {0}'.format( data ) )
     return self._Write( data )
 
-  def _ReadHeaders( self ):
-    parts = self._buffer.split( bytes( '\r\n\r\n', 'utf-8' ), 1 )
-
-    if len( parts ) > 1:
-      headers = parts[ 0 ]
-      for header_line in headers.split( bytes( '\r\n', 'utf-8' ) ):
-        if bytes( '\n', 'utf-8' ) in header_line:
-          # Work around bugs in cppdbg where mono spams nonesense to stdout.
-          # This is such a dodgyhack, but it fixes the issues.
-          header_line = header_line.split( bytes( '\n', 'utf-8' ) )[ -1 ]
-
-        if header_line.strip():
-          key, value = str( header_line, 'utf-8' ).split( ':', 1 )
-          self._headers[ key ] = value
-
-      # Chomp (+4 for the 2 newlines which were the separator)
-      # self._buffer = self._buffer[ len( headers[ 0 ] ) + 4 : ]
-      self._buffer = parts[ 1 ]
-      self._SetState( 'READ_BODY' )
-      return
-
-    # otherwise waiting for more data
+  def _ParseMessages( self ):
+    """Generator which yields each message read from the buffer, or None when
+    it needs more data. Note that the buffer and read offset may change whilst
+    it is suspended."""
+    while True:
+      while True:
+        # Fast path: a well-formed header block, parsed in a single regex match
+        match = HEADER_RE.match( self._buffer, self._read_offset )
+        if match:
+          content_length = int( match.group( 1 ) )
+          self._read_offset = match.end()
+          break
+
+        end = self._buffer.find( CRLFCRLF, self._read_offset )
+        if end >= 0:
+          # Slow path: only here do we need the headers themselves
+          header_block = self._buffer[ self._read_offset : end ]
+
+          # Chomp the separator before parsing, so that if the headers are
+          # garbage we don't try and parse them again next time
+          self._read_offset = end + len( CRLFCRLF )
+
+          headers = self._ReadHeaderLines( header_block )
+          content_length = headers.get( 'Content-Length' )
+          if content_length is not None:
+            content_length = int( content_length )
+          break
+
+        # Waiting for more data
+        yield None
+
+      if content_length is None:
+        # Ug oh. We seem to have all the headers, but no Content-Length
+        # Skip to reading headers. Because, what else can we do.
+        self._logger.error( 'Missing Content-Length header in: {0}'.format(
+          json.dumps( headers ) ) )
+
+        self._buffer.clear()
+        self._read_offset = 0
+        continue
+
+      while len( self._buffer ) - self._read_offset < content_length:
+        # Need more data
+        yield None
+
+      end = self._read_offset + content_length
+      # Both orjson and json decode the UTF-8 themselves, so don't bother
+      # creating a str
+      payload = self._buffer[ self._read_offset : end ]
+      self._read_offset = end
+
+      # self._logger.debug( 'Message received (raw): %s', payload )
 
-  def _ReadBody( self ):
-    try:
-      content_length = int( self._headers[ 'Content-Length' ] )
-    except KeyError:
-      # Ug oh. We seem to have all the headers, but no Content-Length
-      # Skip to reading headers. Because, what else can we do.
-      self._logger.error( 'Missing Content-Length header in: {0}'.format(
-        json.dumps( self._headers ) ) )
-
-      self._buffer = bytes( '', 'utf-8' )
-      self._SetState( 'READ_HEADER' )
-      return
+      try:
+        message = _Loads( payload )
+      except Exception:
+        # Skip it, so that we still dispatch the other messages we've read
+        self._logger.exception( "Invalid message received: %s",
+                                payload.decode( 'utf-8', errors = 'replace' ) )
+        continue
 
-    if len( self._buffer ) < content_length:
-      # Need more data
-      assert self._state == 'READ_BODY'
-      return
+      if self._logger.isEnabledFor( logging.DEBUG ):
+        self._logger.debug( 'Message received: %s', message )
 
-    payload = str( self._buffer[ : content_length ], 'utf-8' )
-    self._buffer = self._buffer[ content_length : ]
+      yield message
 
-    # self._logger.debug( 'Message received (raw): %s', payload )
-    # We read the message, so the next time we get data from the socket it must
-    # be a header.
-    self._SetState( 'READ_HEADER' )
+  def _ReadHeaderLines( self, header_block ):
+    headers = {}
+    for header_line in header_block.split( CRLF ):
+      if LF in header_line:
+        # Work around bugs in cppdbg where mono spams nonesense to stdout.
+        # This is such a dodgyhack, but it fixes the issues.
+        header_line = header_line.split( LF )[ -1 ]
 
-    try:
-      message = json.loads( payload, strict = False )
-    except Exception:
-      self._logger.exception( "Invalid message received: %s", payload )
-      raise
+      if not header_line.strip():
+        continue
 
-    self._logger.debug( 'Message received: {0}'.format( message ) )
+      header_line = str( header_line, 'utf-8', errors = 'replace' )
+      if ':' not in header_line:
+        self._logger.error( 'Ignoring invalid header line: {0}'.format(
+          header_line ) )
+        continue
 
-    self._OnMessageReceived( message )
+      key, value = header_line.split( ':', 1 )
+      headers[ key ] = value
 
+    return headers
 
   def _OnMessageReceived( self, message ):
     if not self._handlers:
@@ -284,7 +360,7 @@ class DebugAdapterConnection( object ):
         self._logger.exception( 'Duplicate response: {}'.format( message ) )
         return
 
-      _KillTimer( request )
+      self._KillTimer( request )
 
       if message[ 'success' ]:
         if request.handler:
@@ -307,25 +383,79 @@ class DebugAdapterConnection( object ):
         else:
           self._logger.error( 'Request failed (unhandled): %s', reason )
           for h in self._handlers:
-            if 'OnFailure' in dir( h ):
-              if h.OnFailure( reason, request.msg, message ):
+            on_failure = getattr( h, 'OnFailure', None )
+            if on_failure is not None:
+              if on_failure( reason, request.msg, message ):
                 break
 
     elif message[ 'type' ] == 'event':
-      method = 'OnEvent_' + message[ 'event' ]
+      # Interned, so that the attribute lookups below can use the type's
+      # method cache
+      method = sys.intern( 'OnEvent_' + message[ 'event' ] )
       for h in self._handlers:
-        if method in dir( h ):
-          if getattr( h, method )( message ):
+        handler = getattr( h, method, None )
+        if handler is not None:
+          if handler( message ):
             break
     elif message[ 'type' ] == 'request':
-      method = 'OnRequest_' + message[ 'command' ]
+      method = sys.intern( 'OnRequest_' + message[ 'command' ] )
       for h in self._handlers:
-        if method in dir( h ):
-          if getattr( h, method )( message ):
+        handler = getattr( h, method, None )
+        if handler is not None:
+          if handler( message ):
             break
 
+  def _StartTimer( self, timeout ):
+    if self._timeout_callback is not None:
+      return int( _timer_start( timeout, self._timeout_callback ) )
+
+    return int( vim.eval(
+      'timer_start( {}, '
+      '             function( "vimspector#internal#channel#Timeout", '
+      '                       [ {} ] ) )'.format(
+        timeout,
+        self._session_id ) ) )
+
+  def _KillTimer( self, request ):
+    if request.expiry_id is not None:
+      self._timer_to_request_id.pop( request.expiry_id, None )
+      if _timer_stop is not None:
+        _timer_stop( request.expiry_id )
+      else:
+        vim.eval( 'timer_stop( {} )'.format( request.expiry_id ) )
+      request.expiry_id = None
+
+  def _KillTimers( self, requests ):
+    timer_ids = []
+    for request in requests:
+      if request.expiry_id is not None:
+        self._timer_to_request_id.pop( request.expiry_id, None )
+        timer_ids.append( request.expiry_id )
+        request.expiry_id = None
+
+    if timer_ids:
+      vim.eval( 'map( {}, {{ _, v -> timer_stop( v ) }} )'.format(
+        json.dumps( timer_ids ) ) )
+
+
+def _Dumps( msg ):
+  if orjson is not None:
+    try:
+      return orjson.dumps( msg, option = orjson.OPT_NON_STR_KEYS )
+    except orjson.JSONEncodeError:
+      # e.g. integers too large for orjson; json can handle them
+      pass
+
+  return json.dumps( msg, separators = ( ',', ':' ) ).encode( 'utf-8' )
+
+
+def _Loads( payload ):
+  if orjson is not None:
+    try:
+      return orjson.loads( payload )
+    except orjson.JSONDecodeError:
+      # orjson is strict about control characters in strings, which some
+      # adapters send, so fall back to json (non-strict) to be sure
+      pass
 
-def _KillTimer( request ):
-  if request.expiry_id is not None:
-    vim.eval( 'timer_stop( {} )'.format( request.expiry_id ) )
-    request.expiry_id = None
+  return json.loads( payload, strict = False )
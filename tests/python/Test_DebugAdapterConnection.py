@@ -0,0 +1,238 @@
+import json
+import sys
+import unittest
+from unittest import mock
+
+
+class StubVim( object ):
+  """Just enough of the vim module for DebugAdapterConnection"""
+  def __init__( self ):
+    self.timers = 0
+
+  def eval( self, expr ):
+    if expr.startswith( 'timer_start' ):
+      self.timers += 1
+      return str( self.timers )
+    return '0'
+
+  def command( self, cmd ):
+    pass
+
+
+try:
+  import vim # noqa
+except ImportError:
+  # Allow running outside of vim
+  sys.modules[ 'vim' ] = StubVim()
+
+from vimspector import debug_adapter_connection, utils
+
+
+def Frame( message ):
+  payload = json.dumps( message ).encode( 'utf-8' )
+  return b'Content-Length: %d\r\n\r\n' % len( payload ) + payload
+
+
+def OutputEvent( seq, output = '' ):
+  return {
+    'seq': seq,
+    'type': 'event',
+    'event': 'output',
+    'body': { 'output': output },
+  }
+
+
+class Handler( object ):
+  def __init__( self, raise_on = None ):
+    self.received = []
+    self.raise_on = raise_on
+
+  def OnEvent_output( self, message ):
+    self.received.append( message )
+    if message[ 'seq' ] == self.raise_on:
+      raise RuntimeError( 'Handler failed' )
+    return True
+
+
+class TestDebugAdapterConnection( unittest.TestCase ):
+  def __init__( self, *args, **kwargs ):
+    super().__init__( *args, **kwargs )
+
+  def setUp( self ):
+    self.vim = StubVim()
+    self.sent = []
+    self.handler = Handler()
+
+    # Always use the vim.eval path for timers, with our stub
+    for patcher in (
+      mock.patch.object( debug_adapter_connection, 'vim', self.vim ),
+      mock.patch.object( debug_adapter_connection, '_timer_start', None ),
+      mock.patch.object( debug_adapter_connection, '_timer_stop', None ),
+      mock.patch.object( utils, 'SetUpLogging' ),
+    ):
+      patcher.start()
+      self.addCleanup( patcher.stop )
+
+    self.connection = debug_adapter_connection.DebugAdapterConnection(
+      handlers = [ self.handler ],
+      session_id = 0,
+      send_func = self._Send )
+
+  def _Send( self, data ):
+    self.sent.append( data )
+    return True
+
+  def _ReceivedSeqs( self ):
+    return [ m[ 'seq' ] for m in self.handler.received ]
+
+  def _AssertBufferEmpty( self ):
+    self.assertEqual( len( self.connection._buffer ),
+                      self.connection._read_offset )
+
+  def test_split_frame( self ):
+    data = Frame( OutputEvent( 1, 'some output' ) )
+    for chunk_size in ( 1, 2, 7, len( data ) - 1 ):
+      with self.subTest( chunk_size ):
+        self.handler.received.clear()
+        for i in range( 0, len( data ), chunk_size ):
+          self.connection.OnData( data[ i : i + chunk_size ] )
+
+        self.assertEqual( self._ReceivedSeqs(), [ 1 ] )
+        self._AssertBufferEmpty()
+
+  def test_several_frames_in_one_chunk( self ):
+    self.connection.OnData( b''.join( Frame( OutputEvent( seq ) )
+                                      for seq in range( 1, 6 ) ) )
+    self.assertEqual( self._ReceivedSeqs(), [ 1, 2, 3, 4, 5 ] )
+    self._AssertBufferEmpty()
+
+  def test_frames_spanning_chunks( self ):
+    data = Frame( OutputEvent( 1 ) ) + Frame( OutputEvent( 2 ) )
+    half = len( data ) // 2 + 3
+    self.connection.OnData( data[ : half ] )
+    self.assertEqual( self._ReceivedSeqs(), [ 1 ] )
+    self.connection.OnData( data[ half : ] )
+    self.assertEqual( self._ReceivedSeqs(), [ 1, 2 ] )
+    self._AssertBufferEmpty()
+
+  def test_multibyte_body( self ):
+    output = 'café € \U0001F600'
+    payload = json.dumps( OutputEvent( 1, output ),
+                          ensure_ascii = False ).encode( 'utf-8' )
+    self.assertNotEqual( len( payload ), len( payload.decode( 'utf-8' ) ) )
+
+    # Content-Length counts bytes, not characters. Split it mid-character too.
+    data = b'Content-Length: %d\r\n\r\n' % len( payload ) + payload
+    split = data.index( b'\xe2\x82\xac' ) + 1
+    self.connection.OnData( data[ : split ] )
+    self.connection.OnData( data[ split : ] )
+
+    self.assertEqual( self._ReceivedSeqs(), [ 1 ] )
+    self.assertEqual( self.handler.received[ 0 ][ 'body' ][ 'output' ],
+                      output )
+    self._AssertBufferEmpty()
+
+  def test_str_input( self ):
+    # Neovim passes decoded text rather than bytes
+    output = 'café'
+    payload = json.dumps( OutputEvent( 1, output ), ensure_ascii = False )
+    self.connection.OnData(
+      'Content-Length: {}\r\n\r\n{}'.format( len( payload.encode( 'utf-8' ) ),
+                                             payload ) )
+
+    self.assertEqual( self._ReceivedSeqs(), [ 1 ] )
+    self.assertEqual( self.handler.received[ 0 ][ 'body' ][ 'output' ],
+                      output )
+    self._AssertBufferEmpty()
+
+  def test_junk_before_header( self ):
+    # cppdbg (mono) writes junk to stdout before the headers
+    self.connection.OnData( b'Loaded assembly\nMore junk\n' +
+                            Frame( OutputEvent( 1 ) ) +
+                            Frame( OutputEvent( 2 ) ) )
+    self.assertEqual( self._ReceivedSeqs(), [ 1, 2 ] )
+    self._AssertBufferEmpty()
+
+  def test_missing_content_length( self ):
+    with self.assertLogs( 'vimspector.debug_adapter_connection',
+                          level = 'ERROR' ):
+      self.connection.OnData( b'Content-Type: json\r\n\r\n{}' )
+    self.assertEqual( self._ReceivedSeqs(), [] )
+
+    # We can carry on afterwards
+    self.connection.OnData( Frame( OutputEvent( 1 ) ) )
+    self.assertEqual( self._ReceivedSeqs(), [ 1 ] )
+    self._AssertBufferEmpty()
+
+  def test_invalid_header_line( self ):
+    with self.assertLogs( 'vimspector.debug_adapter_connection',
+                          level = 'ERROR' ):
+      self.connection.OnData( Frame( OutputEvent( 1 ) ) + b'Garbage\r\n\r\n' )
+    self.assertEqual( self._ReceivedSeqs(), [ 1 ] )
+
+    self.connection.OnData( Frame( OutputEvent( 2 ) ) )
+    self.assertEqual( self._ReceivedSeqs(), [ 1, 2 ] )
+
+  def test_invalid_content_length( self ):
+    self.connection.OnData( Frame( OutputEvent( 1 ) ) )
+    with self.assertRaises( ValueError ):
+      self.connection.OnData( b'Content-Length: abc\r\nX: y\r\n\r\n' )
+
+    self.connection.OnData( Frame( OutputEvent( 2 ) ) )
+    self.assertEqual( self._ReceivedSeqs(), [ 1, 2 ] )
+
+  def test_handler_raises_mid_batch( self ):
+    self.handler.raise_on = 1
+    with self.assertRaises( RuntimeError ):
+      self.connection.OnData( b''.join( Frame( OutputEvent( seq ) )
+                                        for seq in ( 1, 2, 3 ) ) )
+    self.assertEqual( self._ReceivedSeqs(), [ 1 ] )
+
+    # The remaining messages are still buffered, and are dispatched next time
+    self.connection.OnData( b'' )
+    self.assertEqual( self._ReceivedSeqs(), [ 1, 2, 3 ] )
+    self._AssertBufferEmpty()
+
+  def test_send_content_length( self ):
+    self.connection.DoRequest( None, {
+      'command': 'evaluate',
+      'arguments': { 'expression': 'café' }
+    } )
+
+    self.assertEqual( len( self.sent ), 1 )
+    header, payload = bytes( self.sent[ 0 ] ).split( b'\r\n\r\n', 1 )
+    self.assertEqual( header, b'Content-Length: %d' % len( payload ) )
+    message = json.loads( payload )
+    self.assertEqual( message[ 'type' ], 'request' )
+    self.assertEqual( message[ 'arguments' ][ 'expression' ], 'café' )
+
+  def test_response_and_timeout( self ):
+    responses = []
+    failures = []
+    self.connection.DoRequest( responses.append,
+                               { 'command': 'threads' },
+                               lambda reason, msg: failures.append( reason ) )
+    self.connection.DoRequest( responses.append,
+                               { 'command': 'threads' },
+                               lambda reason, msg: failures.append( reason ) )
+
+    self.connection.OnData( Frame( {
+      'seq': 1,
+      'type': 'response',
+      'request_seq': 1,
+      'command': 'threads',
+      'success': True,
+      'body': {},
+    } ) )
+    self.assertEqual( len( responses ), 1 )
+    self.assertEqual( failures, [] )
+
+    # The timer for the second request fires
+    self.connection.OnRequestTimeout( '2' )
+    self.assertEqual( failures, [ 'Timeout' ] )
+    self.assertEqual( self.connection._outstanding_requests, {} )
+
+
+assert unittest.main( module=__name__,
+                      testRunner=unittest.TextTestRunner( sys.stdout ),
+                      exit=False ).result.wasSuccessful()
@@ -32,3 +32,8 @@ function! Test_CoreUtils()
   call SkipNeovim()
   call s:RunPyFile( 'Test_CoreUtils.py' )
 endfunction
+
+function! Test_DebugAdapterConnection()
+  call SkipNeovim()
+  call s:RunPyFile( 'Test_DebugAdapterConnection.py' )
+endfunction